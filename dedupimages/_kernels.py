@@ -0,0 +1,65 @@
+"""Compiled kernels for hash comparison.
+
+Requires Numba. When it's not installed, `find_pairs` is None
+and callers fall back to NumPy.
+
+"""
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+def _popcount64(x):
+    """Count set bits in 64bit unsigned int (SWAR, no lookup table)."""
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = ((x & np.uint64(0x3333333333333333)) +
+         ((x >> np.uint64(2)) & np.uint64(0x3333333333333333)))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def _find_pairs(h, max_bits):
+    """Find pairs of 64bit hashes which differ in at most `max_bits` bits.
+
+    Args:
+        h: Array of hashes, dtype uint64.
+        max_bits: Maximal number of differing bits.
+
+    Returns:
+        Array of shape (K, 3), rows (i, j, bits) with i < j,
+        sorted by i, then j.
+
+    """
+    n = h.shape[0]
+    # First pass: count matches in each row, so the rows can be processed
+    # in parallel and written to precomputed offsets in the second pass
+    counts = np.zeros(n + 1, dtype=np.int64)
+    for i in prange(n):
+        c = 0
+        for j in range(i + 1, n):
+            if _popcount64(h[i] ^ h[j]) <= max_bits:
+                c += 1
+        counts[i + 1] = c
+    offsets = np.cumsum(counts)
+    pairs = np.empty((offsets[n], 3), dtype=np.int64)
+    for i in prange(n):
+        k = offsets[i]
+        for j in range(i + 1, n):
+            bits = _popcount64(h[i] ^ h[j])
+            if bits <= max_bits:
+                pairs[k, 0] = i
+                pairs[k, 1] = j
+                pairs[k, 2] = bits
+                k += 1
+    return pairs
+
+
+if njit is not None:
+    _popcount64 = njit(inline='always')(_popcount64)
+    find_pairs = njit(parallel=True, fastmath=True, cache=True)(_find_pairs)
+else:
+    find_pairs = None
@@ -10,6 +10,7 @@ class Config:
         self.algorithm = 'mh'
         self.threshold = 90.0
         self.viewer = 'xdg-open'
+        self.pool = 'thread'
         self.dbpath = DEFAULT_DB_PATH
 
     def try_load(self, path=DEFAULT_CONF_PATH):
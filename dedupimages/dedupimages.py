@@ -3,12 +3,17 @@ import os.path
 import sys
 import json
 import gzip
-from concurrent.futures import ThreadPoolExecutor as PoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
 
 from dedupimages.imagehash import ImageHash, compute_hash
 from dedupimages.hashdb import HashDB
 from dedupimages.config import Config
 
+# Database is saved as .npz file, which is a zip archive
+ZIP_MAGIC = b'PK\x03\x04'
+
 
 class DedupImages:
 
@@ -49,14 +54,17 @@ class DedupImages:
 
     """
 
-    FORMATS = ['.png', '.jpeg', '.jpg', '.tiff', '.tif']
+    FORMATS = ('.png', '.jpeg', '.jpg', '.tiff', '.tif')
 
     def __init__(self, cfg: Config):
         self.algorithm = cfg.algorithm
         self.threshold = cfg.threshold
         self.viewer = cfg.viewer
+        self.pool = cfg.pool
         self.dbpath = cfg.dbpath
         self.hashdb = HashDB()
+        # Database was modified and needs to be saved
+        self._dirty = False
 
     def process_args(self):
         # Process program args
@@ -76,13 +84,18 @@ class DedupImages:
                         help=self.cmd_prune.__doc__)
         ap.add_argument('-a', '--algorithm', default=self.algorithm,
                         help='Perceptual hash algorithm. '
-                             'Options: dct | mh | radial. Default: %(default)s')
+                             'Options: dct | dct32 | mh | radial. '
+                             'Default: %(default)s')
         ap.add_argument('-t', '--threshold', type=float, default=self.threshold,
                         help='Minimal similarity ratio for image comparison. '
                              'Default: %(default)s%%')
+        ap.add_argument('--pool', choices=('thread', 'process'),
+                        default=self.pool,
+                        help='Compute image hashes in threads or processes. '
+                             'Default: %(default)s')
         ap.add_argument('-F', '--fast', action='store_true',
                         help='Faster check for file modification '
-                             '(Compare first 512 bytes only)')
+                             '(Compare first 64 KiB only)')
         ap.add_argument('-f', '--file',
                         help='Search for duplicates of this file')
         ap.add_argument('-r', '--recursive', action='store_true',
@@ -99,6 +112,7 @@ class DedupImages:
         args = self.process_args()
         self.algorithm = args.algorithm
         self.threshold = args.threshold
+        self.pool = args.pool
         self.dbpath = os.path.expanduser(args.db)
         path = os.path.realpath(os.path.expanduser(args.path)) \
             if args.path else None
@@ -106,19 +120,21 @@ class DedupImages:
                          args.cleanup or args.prune)
         self.load_database(must_exist=cmd_specified and not args.hash)
         # Execute commands
-        if args.remove:
-            self.cmd_remove(path, args.recursive)
-        if args.hash:
-            self.cmd_hash(path, args.recursive, args.fast)
-        if args.cleanup:
-            self.cmd_cleanup(path, args.fast)
-        if args.prune:
-            self.cmd_prune()
-        if args.search:
-            self.cmd_search(path, args.file, args.skip_bin, args.view)
-        if not cmd_specified:
-            self.cmd_hash(path, args.recursive, args.fast)
-            self.cmd_cleanup(path, args.fast)
+        # Modifications are saved once, also when interrupted,
+        # but before search, which filters the database in memory
+        try:
+            if args.remove:
+                self.cmd_remove(path, args.recursive)
+            if args.hash or not cmd_specified:
+                self.cmd_hash(path, args.recursive, args.fast)
+            if args.cleanup or not cmd_specified:
+                self.cmd_cleanup(path, args.fast)
+            if args.prune:
+                self.cmd_prune()
+        finally:
+            if self._dirty:
+                self.save_database()
+        if args.search or not cmd_specified:
             self.cmd_search(path, args.file, args.skip_bin, args.view)
 
     def cmd_hash(self, path, recursive, fast_compare=False):
@@ -128,12 +144,12 @@ class DedupImages:
         else:
             paths_to_hash = [p for p in self.hashdb.list_top_paths()
                              if os.path.exists(p)]
-        try:
+        self._dirty = True
+        with self.create_executor() as executor:
             for path in paths_to_hash:
-                for dirpath, filenames in self.list_directories(path, recursive):
-                    self.update_db(dirpath, filenames, fast_compare)
-        finally:
-            self.save_database()
+                for dirpath, filenames in self.list_directories(path,
+                                                                recursive):
+                    self.update_db(executor, dirpath, filenames, fast_compare)
 
     def cmd_search(self, path, sample_file=None, skip_bin=False, view=False):
         """Search database for similar images in `path`"""
@@ -156,17 +172,21 @@ class DedupImages:
 
     def cmd_remove(self, path, recursive):
         """Remove files in `path` from database"""
-        def in_path(filename):
+        prefix = os.path.join(path, '')
+        prefix_len = len(prefix)
+        for item in self.hashdb.items:
             if recursive:
-                return filename.startswith(path)
+                removed = {fn for fn in item.file_names
+                           if fn.startswith(prefix)}
             else:
-                return os.path.dirname(filename) == path
-        for item in self.hashdb.items:
-            filtered = {fn for fn in item.file_names if not in_path(fn)}
-            for removed_filename in item.file_names.difference(filtered):
+                # File directly in `path`: no more separators after prefix
+                removed = {fn for fn in item.file_names
+                           if fn.startswith(prefix) and
+                           fn.find(os.sep, prefix_len) == -1}
+            for removed_filename in removed:
                 print("Removing", removed_filename)
-            item.file_names = filtered
-        self.save_database()
+            item.file_names -= removed
+        self._dirty = True
 
     def cmd_cleanup(self, path=None, fast=False):
         """Check files in `path`, remove references
@@ -177,7 +197,7 @@ class DedupImages:
             item.check_file_names(path=path, fast=fast)
             for filename in original_file_names.difference(item.file_names):
                 print("Removing file reference", filename)
-        self.save_database()
+        self._dirty = True
 
     def cmd_prune(self):
         """Check items in database, remove those without any references to files
@@ -187,13 +207,20 @@ class DedupImages:
         pruned = original_items_len - len(self.hashdb.items)
         if pruned:
             print("Pruned", pruned, "hashed files without any file names")
-        self.save_database()
+        self._dirty = True
 
     def load_database(self, must_exist=False):
         try:
-            with gzip.open(self.dbpath, 'rt', encoding='utf8') as f:
-                dbitems = json.load(f)
-            self.hashdb = HashDB.load(dbitems)
+            with open(self.dbpath, 'rb') as f:
+                if f.read(len(ZIP_MAGIC)) == ZIP_MAGIC:
+                    f.seek(0)
+                    with np.load(f) as arrays:
+                        self.hashdb = HashDB.load_arrays(arrays)
+                else:
+                    # Database written by older version: gzipped JSON
+                    f.seek(0)
+                    with gzip.open(f, 'rt', encoding='utf8') as gz:
+                        self.hashdb = HashDB.load(json.load(gz))
             print("Loaded database: %s files" % len(self.hashdb.items))
         except IOError:
             if must_exist:
@@ -203,47 +230,73 @@ class DedupImages:
                   file=sys.stderr)
 
     def save_database(self):
-        dbitems = self.hashdb.dump()
-        with gzip.open(self.dbpath, 'wt', encoding='utf8') as f:
-            json.dump(dbitems, f, indent='\t')
+        arrays = self.hashdb.dump_arrays()
+        with open(self.dbpath, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        self._dirty = False
 
     def list_directories(self, path, recursive):
-        if recursive:
-            for dirpath, _dirnames, filenames in os.walk(path):
-                filenames = [fname for fname in filenames
-                             if self.is_image(fname)]
-                filenames.sort()
-                yield dirpath, filenames
-        else:
-            filenames = [fname for fname in os.listdir(path)
-                         if self.is_image(fname)]
+        """Generate tuples (dirpath, filenames) with sorted image file names.
+
+        Subdirectories are traversed depth-first when `recursive`, in same
+        order as :func:`os.walk` (not following symlinks). The directory
+        entries come from :func:`os.scandir`, which avoids extra stat calls.
+
+        """
+        dirpaths = [path]
+        while dirpaths:
+            dirpath = dirpaths.pop()
+            filenames = []
+            subdirs = []
+            try:
+                with os.scandir(dirpath) as entries:
+                    for entry in entries:
+                        if recursive and entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif self.is_image(entry.name) and not entry.is_dir():
+                            filenames.append(entry.name)
+            except OSError:
+                if dirpath == path:
+                    raise
+                continue
             filenames.sort()
-            yield path, filenames
+            yield dirpath, filenames
+            dirpaths.extend(reversed(subdirs))
 
     def is_image(self, fname):
-        _root, ext = os.path.splitext(fname)
-        if ext.lower() in self.FORMATS:
-            return True
+        return fname.lower().endswith(self.FORMATS)
+
+    def create_executor(self):
+        """Create pool of workers for computing image hashes.
 
-    def update_db(self, path, filenames, fast_compare):
+        The pHash functions release the GIL, so threads run in parallel
+        with less overhead. Processes can be selected with '--pool process'.
+
+        """
+        max_workers = os.cpu_count() or 4
+        if self.pool == 'process':
+            return ProcessPoolExecutor(max_workers=max_workers)
+        return ThreadPoolExecutor(max_workers=max_workers)
+
+    def update_db(self, executor, path, filenames, fast_compare):
         print('Updating', path)
-        with PoolExecutor(max_workers=os.cpu_count() or 4) as executor:
-            # Compute hashes for new or updated files
-            hashes = []
-            imagehash_class = ImageHash.get_subclass(self.algorithm)
-            for fname in filenames:
-                filepath = os.path.join(path, fname)
-                file_hash = self.hashdb.add(filepath, fast_compare=fast_compare)
-                if self.algorithm not in file_hash.image_hash:
-                    # Not seen before -> compute image hash
-                    future_imghash = executor.submit(compute_hash,
-                                                     imagehash_class,
-                                                     filepath)
-                    hashes.append((file_hash, future_imghash))
-            # Write results back into HashItem objects
-            for file_hash, future_imghash in hashes:
-                imghash = future_imghash.result(timeout=60)
-                file_hash.image_hash[self.algorithm] = imghash
+        # Compute hashes for new or updated files
+        # (workers compute image hashes while next files are being added)
+        hashes = []
+        for fname in filenames:
+            filepath = os.path.join(path, fname)
+            file_hash = self.hashdb.add(filepath, fast_compare=fast_compare)
+            if self.algorithm not in file_hash.image_hash:
+                # Not seen before -> compute image hash
+                file_hash.prefetch()
+                future_imghash = executor.submit(compute_hash,
+                                                 self.algorithm,
+                                                 filepath)
+                hashes.append((file_hash, future_imghash))
+        # Write results back into HashItem objects
+        for file_hash, future_imghash in hashes:
+            imghash = future_imghash.result(timeout=60)
+            file_hash.image_hash[self.algorithm] = imghash
 
     def show_binary_dupes(self, gui=False):
         """View groups of files with same binary content.
@@ -254,14 +307,15 @@ class DedupImages:
         Raises StopIteration if quit was requested.
 
         """
-        items = (item for item in self.hashdb.items if len(item.file_names) > 1)
+        items = self.hashdb.multi_ref_items()
         for n, item in enumerate(items, start=1):
             title = "Binary equal (set #%s)" % n
             print('--- %s ---' % title)
-            for fname in item.file_names:
+            file_list = sorted(item.file_names)
+            for fname in file_list:
                 print(fname)
             if gui:
-                self.view(title, list(item.file_names))
+                self.view(title, file_list)
 
     def search_db_for_dupes(self, gui=False):
         """Find and view groups of perceptually similar images.
@@ -1,16 +1,46 @@
 import hashlib
 import os
 from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 from dedupimages.imagehash import ImageHash
 
 
+BLOCK_SIZE = 1024 * 1024
+HEAD_SIZE = 64 * 1024
+
+# Version of array layout written by HashDB.dump_arrays
+DB_VERSION = 1
+
+
+def read_blocks(f, block_size=BLOCK_SIZE):
+    """Read file `f` by blocks, prefetching next block in background.
+
+    Reading of next block overlaps with processing of current one
+    (hashlib releases the GIL while hashing large blocks).
+
+    """
+    data = f.read(block_size)
+    if len(data) < block_size:
+        # Small file, don't bother with the thread
+        if data:
+            yield data
+        return
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        while data:
+            next_data = reader.submit(f.read, block_size)
+            yield data
+            data = next_data.result()
+
+
 class HashItem:
 
     """Files are indexed by content properties:
 
     - file size
-    - first 512 bytes hashed
+    - first 64 KiB hashed
     - whole content hashed
     - perceptual image hashes
 
@@ -21,7 +51,7 @@ class HashItem:
     def __init__(self, filename=None):
         self.file_names = {filename} if filename else set()
         self.file_size = 0
-        self.first_512_sha256 = None
+        self.head_blake2b = None
         self._content_sha256 = None
         self.image_hash = {}
         self._partial_hash = None
@@ -29,9 +59,21 @@ class HashItem:
         if filename:
             self._file = open(filename, 'rb')
             self.file_size = os.fstat(self._file.fileno()).st_size
-            data = self._file.read(512)
+            data = self._file.read(HEAD_SIZE)
             self._partial_hash = hashlib.sha256(data)
-            self.first_512_sha256 = self._partial_hash.hexdigest()
+            self.head_blake2b = hashlib.blake2b(data,
+                                                digest_size=16).hexdigest()
+
+    def prefetch(self):
+        """Ask OS to read rest of the file into page cache in background.
+
+        Following reads of the file (image hash computation, content hash)
+        don't have to wait for the disk.
+
+        """
+        if self._file and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self._file.fileno(), 0, 0,
+                             os.POSIX_FADV_WILLNEED)
 
     def binary_equal(self, other: 'HashItem', fast=False):
         """Compare binary content.
@@ -39,11 +81,16 @@ class HashItem:
         File names don't matter.
         Neither image hashes matter, they should be same when binary content is.
 
-        Fast compare checks only file size and first 512 bytes.
+        Fast compare checks only file size and first 64 KiB.
+        Items loaded from older database don't have the head hash,
+        these are always compared by whole content.
 
         """
+        if self.head_blake2b is None or other.head_blake2b is None:
+            return (self.file_size == other.file_size and
+                    self.content_sha256 == other.content_sha256)
         return (self.file_size == other.file_size and
-                self.first_512_sha256 == other.first_512_sha256 and
+                self.head_blake2b == other.head_blake2b and
                 (fast or self.content_sha256 == other.content_sha256))
 
     def check_file_names(self, path=None, fast=False):
@@ -62,6 +109,9 @@ class HashItem:
                 file_hash = HashItem(filename)
                 if self.binary_equal(file_hash, fast=fast):
                     file_names_ok.add(filename)
+                    if self.head_blake2b is None:
+                        # Upgrade item from older database
+                        self.head_blake2b = file_hash.head_blake2b
             except IOError:
                 pass
         self.file_names = file_names_ok
@@ -70,12 +120,8 @@ class HashItem:
     def content_sha256(self):
         """Content hash is coputed lazily"""
         if self._file and self._partial_hash:
-            while True:
-                data = self._file.read(32 * 1024)
-                if data:
-                    self._partial_hash.update(data)
-                else:
-                    break
+            for data in read_blocks(self._file):
+                self._partial_hash.update(data)
             self._content_sha256 = self._partial_hash.hexdigest()
             self._file.close()
             self._file = None
@@ -87,7 +133,7 @@ class HashItem:
         d = {
             'names': tuple(self.file_names),
             'size': self.file_size,
-            'first_512b_sha256': self.first_512_sha256,
+            'head_64k_blake2b': self.head_blake2b,
             'sha256': self.content_sha256,
         }
         for name, value in self.image_hash.items():
@@ -100,7 +146,7 @@ class HashItem:
         i = cls()
         i.file_names = set(d['names'])
         i.file_size = d['size']
-        i.first_512_sha256 = d['first_512b_sha256']
+        i.head_blake2b = d.get('head_64k_blake2b')
         i._content_sha256 = d['sha256']
         for name, value in d.items():
             if name.startswith('ph_'):
@@ -122,7 +168,7 @@ class HashDB:
         in database. If the content is equal to existing item, then the filename
         is added to this item. Otherwise new item is created.
 
-        If `fast_compare` is requested, only hash of first 512 bytes and file
+        If `fast_compare` is requested, only hash of first 64 KiB and file
         size are compared.
 
         Returns HashItem object (added or found) with the filename.
@@ -132,6 +178,9 @@ class HashDB:
         for item in self.items:
             if item.binary_equal(file_hash, fast=fast_compare):
                 item.file_names.add(filename)
+                if item.head_blake2b is None:
+                    # Upgrade item from older database
+                    item.head_blake2b = file_hash.head_blake2b
                 return item
         self.items.append(file_hash)
         return file_hash
@@ -142,6 +191,14 @@ class HashDB:
             if not item.file_names:
                 self.items.remove(item)
 
+    def multi_ref_items(self):
+        """Generate items with more than one file name.
+
+        These are groups of files with same binary content.
+
+        """
+        return (item for item in self.items if len(item.file_names) > 1)
+
     def filter_by_path(self, path):
         """Keep items with filename in `path`, drop the rest."""
         filtered_items = []
@@ -187,21 +244,42 @@ class HashDB:
         Returned pairs can be grouped by fname_a without sorting.
 
         """
-        for item_a, item_b in combinations(self.items, 2):
-            # Need file names for report
-            if not item_a.file_names or not item_b.file_names:
-                continue
-            # Need hashes to compare
-            hash_a = item_a.image_hash.get(hash_name)
-            hash_b = item_b.image_hash.get(hash_name)
-            if not hash_a or not hash_b:
-                continue
-            # Compare and report with one of file names
-            distance = hash_a.distance(hash_b)
+        # Need file names for report and hashes to compare
+        items = [item for item in self.items
+                 if item.file_names and item.image_hash.get(hash_name)]
+        if ImageHash.get_subclass(hash_name).batch:
+            pairs = self._compare_batch(items, threshold, hash_name)
+        else:
+            pairs = self._compare_each(items, threshold, hash_name)
+        for item_a, item_b, distance in pairs:
+            # Report with one of file names
+            fname_a = sorted(item_a.file_names)[0]
+            fname_b = sorted(item_b.file_names)[0]
+            yield fname_a, fname_b, distance
+
+    @staticmethod
+    def _compare_each(items, threshold, hash_name):
+        """Compare all pairs of `items` one by one."""
+        for item_a, item_b in combinations(items, 2):
+            distance = item_a.image_hash[hash_name].distance(
+                item_b.image_hash[hash_name])
             if distance <= threshold:
-                fname_a = sorted(item_a.file_names)[0]
-                fname_b = sorted(item_b.file_names)[0]
-                yield fname_a, fname_b, distance
+                yield item_a, item_b, distance
+
+    @staticmethod
+    def _compare_batch(items, threshold, hash_name):
+        """Compare all pairs of `items` using stacked hashes.
+
+        Yields the pairs in same order as :meth:`_compare_each`.
+
+        """
+        if len(items) < 2:
+            return
+        hash_class = ImageHash.get_subclass(hash_name)
+        stacked = hash_class.stack([item.image_hash[hash_name]
+                                    for item in items])
+        for i, j, distance in hash_class.close_pairs(stacked, threshold):
+            yield items[i], items[j], distance
 
     def find_groups(self, threshold, hash_name):
         """Find groups of similar images, skipping derived pairs.
@@ -242,9 +320,14 @@ class HashDB:
 
     def query(self, imghash, threshold, hash_name):
         """Find images close to given hash."""
-        for item in self.items:
-            item_hash = item.image_hash.get(hash_name)
-            distance = imghash.distance(item_hash)
+        items = [item for item in self.items
+                 if item.file_names and item.image_hash.get(hash_name)]
+        hashes = [item.image_hash[hash_name] for item in items]
+        if imghash.batch and items:
+            distances = imghash.distance_many(imghash.stack(hashes)).tolist()
+        else:
+            distances = [imghash.distance(item_hash) for item_hash in hashes]
+        for item, distance in zip(items, distances):
             if distance <= threshold:
                 fname = sorted(item.file_names)[0]
                 yield fname, distance
@@ -258,6 +341,104 @@ class HashDB:
         i.items = [HashItem.load(d) for d in l]
         return i
 
+    def dump_arrays(self) -> dict:
+        """Dump the database into dict of numpy arrays.
+
+        This is much faster to save and load than :meth:`dump`,
+        see :func:`numpy.savez_compressed`.
+
+        """
+        items = self.items
+        names = [sorted(item.file_names) for item in items]
+        arrays = {
+            'version': np.array(DB_VERSION),
+            'names': _pack_names(fn for item_names in names
+                                 for fn in item_names),
+            'name_counts': np.array([len(n) for n in names], dtype=np.int64),
+            'size': np.array([item.file_size for item in items],
+                             dtype=np.int64),
+        }
+        arrays.update(_pack_digests('head_64k_blake2b', 16,
+                                    [item.head_blake2b for item in items]))
+        arrays.update(_pack_digests('sha256', 32,
+                                    [item.content_sha256 for item in items]))
+        hash_names = {name for item in items
+                      for name, value in item.image_hash.items() if value}
+        for name in sorted(hash_names):
+            idx = [n for n, item in enumerate(items)
+                   if item.image_hash.get(name)]
+            hashes = [items[n].image_hash[name] for n in idx]
+            arrays['ph_' + name] = ImageHash.get_subclass(name).stack(hashes)
+            arrays['ph_' + name + '_idx'] = np.array(idx, dtype=np.int64)
+        return arrays
+
+    @classmethod
+    def load_arrays(cls, arrays) -> 'HashDB':
+        """Load the database from arrays as returned by :meth:`dump_arrays`.
+
+        Raises ValueError if the arrays were written in unknown version.
+
+        """
+        version = int(arrays['version']) if 'version' in arrays else None
+        if version != DB_VERSION:
+            raise ValueError('Unsupported database version: %s' % version)
+        i = cls()
+        names = _unpack_names(arrays['names'])
+        pos = 0
+        for count, size in zip(arrays['name_counts'].tolist(),
+                               arrays['size'].tolist()):
+            item = HashItem()
+            item.file_names = set(names[pos:pos + count])
+            item.file_size = size
+            i.items.append(item)
+            pos += count
+        for n, digest in _unpack_digests(arrays, 'head_64k_blake2b'):
+            i.items[n].head_blake2b = digest
+        for n, digest in _unpack_digests(arrays, 'sha256'):
+            i.items[n]._content_sha256 = digest
+        for key in arrays:
+            if key.startswith('ph_') and not key.endswith('_idx'):
+                name = key[3:]
+                hashes = ImageHash.get_subclass(name).unstack(arrays[key])
+                idx = arrays[key + '_idx'].tolist()
+                for n, value in zip(idx, hashes):
+                    i.items[n].image_hash[name] = value
+        return i
+
+
+def _pack_names(names) -> np.ndarray:
+    """Pack file names into single array of NUL separated UTF-8 bytes."""
+    data = '\0'.join(names).encode('utf8', 'surrogateescape')
+    return np.frombuffer(data, dtype=np.uint8)
+
+
+def _unpack_names(packed) -> list:
+    if not len(packed):
+        return []
+    return packed.tobytes().decode('utf8', 'surrogateescape').split('\0')
+
+
+def _pack_digests(key, size, digests) -> dict:
+    """Pack hex digests into array of raw bytes, `size` bytes per row.
+
+    Missing digests (None) are skipped, indexes of present ones
+    are stored under `key` + '_idx'.
+
+    """
+    idx = [n for n, digest in enumerate(digests) if digest]
+    data = b''.join(bytes.fromhex(digests[n]) for n in idx)
+    return {
+        key: np.frombuffer(data, dtype=np.uint8).reshape(-1, size),
+        key + '_idx': np.array(idx, dtype=np.int64),
+    }
+
+
+def _unpack_digests(arrays, key):
+    """Generate tuples (index, hex digest) from arrays packed by
+    :func:`_pack_digests`."""
+    return zip(arrays[key + '_idx'].tolist(),
+               (row.tobytes().hex() for row in arrays[key]))
+
 
 if __name__ == "__main__":
     # Self test
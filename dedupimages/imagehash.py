@@ -1,15 +1,61 @@
 import phash
 import binascii
+import math
+
+import numpy as np
+
+from dedupimages import _kernels
+
+_INV_64 = 1.0 / 64
+
+# ImageHash subclasses by algorithm name, filled by __init_subclass__
+_registry = {}
+
+
+def _dct_matrix(size):
+    """Compute DCT-II coefficient matrix, as in pHash's ph_dct_matrix."""
+    i = np.arange(size)[:, None]
+    j = np.arange(size)[None, :]
+    matrix = np.sqrt(2 / size) * np.cos(np.pi / size * (j + 0.5) * i)
+    matrix[0, :] = 1 / np.sqrt(size)
+    return matrix.astype(np.float32)
+
+
+_DCT_MATRIX = _dct_matrix(32)
+
+
+def _popcount(arr):
+    """Count set bits in each element of unsigned integer array."""
+    if hasattr(np, 'bitwise_count'):
+        # NumPy >= 2.0
+        return np.bitwise_count(arr)
+    arr = np.ascontiguousarray(arr)[..., None]
+    return np.unpackbits(arr.view(np.uint8), axis=-1).sum(axis=-1)
 
 
 class ImageHash:
 
     """ImageHash base class"""
 
+    __slots__ = ('_hash',)
+
+    #: True if the class implements :meth:`close_pairs`
+    #: and :meth:`distance_many` for batch comparison
+    batch = False
+
+    #: Memory limit for intermediate arrays in batch comparison,
+    #: small enough to keep the working set in CPU cache
+    batch_bytes = 4 * 1024 * 1024
+
     def __init__(self, filename=None):
         if filename:
             self.compute(filename)
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'algorithm' in cls.__dict__:
+            _registry[cls.algorithm()] = cls
+
     @staticmethod
     def get_subclass(algorithm):
         """Return ImageHash subclass which implements algorithm.
@@ -18,10 +64,10 @@ class ImageHash:
             algorithm: Hash algorithm. Refers to algorithm() of ImageHash subclasses.
 
         """
-        for cls in ImageHash.__subclasses__():
-            if cls.algorithm() == algorithm:
-                return cls
-        raise ValueError()
+        try:
+            return _registry[algorithm]
+        except KeyError:
+            raise ValueError('Unknown algorithm: %r' % algorithm) from None
 
     @staticmethod
     def algorithm():
@@ -55,11 +101,74 @@ class ImageHash:
         """
         raise NotImplementedError()
 
+    @classmethod
+    def stack(cls, hashes) -> np.ndarray:
+        """Stack hash values into numpy array.
+
+        Used for batch comparison and binary serialization.
+
+        Args:
+            hashes: Non-empty list of instances of this class.
+
+        Returns:
+            Array with one row per hash.
+
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def unstack(cls, stacked) -> list:
+        """Create instances from array as returned by :meth:`stack`."""
+        raise NotImplementedError()
+
+    @classmethod
+    def distances(cls, stacked_a, stacked_b) -> np.ndarray:
+        """Compute distances between all pairs from two stacks of hashes.
+
+        Args:
+            stacked_a, stacked_b: Arrays as returned by :meth:`stack`.
+
+        Returns:
+            Matrix of normalized distances, shape (len(a), len(b)).
+
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def close_pairs(cls, stacked, threshold):
+        """Find pairs of stacked hashes with distance up to `threshold`.
+
+        Args:
+            stacked: Array as returned by :meth:`stack`.
+            threshold: Maximal normalized distance.
+
+        Returns:
+            Iterable of tuples (i, j, distance), i < j are row indexes
+            into `stacked`. Sorted by i, then j.
+
+        """
+        raise NotImplementedError()
+
+    def distance_many(self, stacked) -> np.ndarray:
+        """Compute distances between this hash and stacked hashes.
+
+        Args:
+            stacked: Array as returned by :meth:`stack`.
+
+        Returns:
+            Array of normalized distances, one per row in `stacked`.
+
+        """
+        return self.distances(self.stack([self]), stacked)[0]
+
 
 class DctImageHash(ImageHash):
 
     """DCT image hash algorithm"""
 
+    __slots__ = ()
+    batch = True
+
     def __init__(self, *args):
         self._hash = 0
         ImageHash.__init__(self, *args)
@@ -71,6 +180,28 @@ class DctImageHash(ImageHash):
     def compute(self, filename):
         self._hash = phash.dct_imagehash(filename)
 
+    @staticmethod
+    def _compute_dct_numpy(pixels):
+        """Compute DCT hash of 32x32 grayscale image.
+
+        This is NumPy implementation of the DCT part of ph_dct_imagehash.
+        The cosine coefficients are precomputed in a matrix,
+        so the transformation is just two matrix multiplications.
+
+        Args:
+            pixels: 32x32 array of luma values.
+
+        Returns:
+            Hash as 64bit int.
+
+        """
+        pixels = np.asarray(pixels, dtype=np.float32)
+        dct = _DCT_MATRIX @ pixels @ _DCT_MATRIX.T
+        # Lowest frequencies, except DC component
+        coeffs = dct[1:9, 1:9].ravel()
+        bits = np.packbits(coeffs > np.median(coeffs), bitorder='little')
+        return int(bits.view('<u8')[0])
+
     @classmethod
     def load(cls, hexhash):
         i = cls()
@@ -78,16 +209,76 @@ class DctImageHash(ImageHash):
         return i
 
     def distance(self, other: 'DctImageHash'):
-        return phash.hamming_distance(self._hash, other._hash) / 64
+        return (self._hash ^ other._hash).bit_count() * _INV_64
+
+    def distance_many(self, stacked):
+        return _popcount(stacked ^ np.uint64(self._hash)) * _INV_64
+
+    @classmethod
+    def stack(cls, hashes):
+        return np.fromiter((h._hash for h in hashes), dtype=np.uint64,
+                           count=len(hashes))
+
+    @classmethod
+    def unstack(cls, stacked):
+        hashes = []
+        for value in stacked.tolist():
+            i = cls()
+            i._hash = value
+            hashes.append(i)
+        return hashes
+
+    @staticmethod
+    def differing_bits(stacked_a, stacked_b):
+        """Count differing bits between all pairs from two stacks."""
+        return _popcount(stacked_a[:, None] ^ stacked_b[None, :])
+
+    @classmethod
+    def close_pairs(cls, stacked, threshold):
+        max_bits = math.floor(threshold * 64)
+        if _kernels.find_pairs is not None:
+            pairs = _kernels.find_pairs(stacked, max_bits).tolist()
+        else:
+            pairs = _hamming_pairs(cls, stacked, max_bits)
+        for i, j, bits in pairs:
+            yield i, j, bits * _INV_64
 
     def __str__(self):
         return '%016X' % self._hash
 
 
+class Dct32ImageHash(DctImageHash):
+
+    """DCT image hash computed with Pillow and NumPy in float32
+
+    Similar to DCT algorithm from pHash, but the image is converted
+    to integer luma and resized by Pillow, then transformed by
+    :meth:`DctImageHash._compute_dct_numpy`. The hashes are not
+    compatible with 'dct'.
+
+    """
+
+    __slots__ = ()
+
+    @staticmethod
+    def algorithm():
+        return 'dct32'
+
+    def compute(self, filename):
+        from PIL import Image
+        with Image.open(filename) as image:
+            image = image.convert('L').resize((32, 32),
+                                              Image.Resampling.BILINEAR)
+        self._hash = self._compute_dct_numpy(image)
+
+
 class MhImageHash(ImageHash):
 
     """Marr-Hildreth image hash algorithm"""
 
+    __slots__ = ()
+    batch = True
+
     def __init__(self, *args):
         self._hash = b''
         ImageHash.__init__(self, *args)
@@ -108,6 +299,38 @@ class MhImageHash(ImageHash):
     def distance(self, other: 'MhImageHash'):
         return phash.hamming_distance_2(self._hash, other._hash)
 
+    @classmethod
+    def stack(cls, hashes):
+        data = np.frombuffer(b''.join(h._hash for h in hashes), dtype=np.uint8)
+        return data.reshape(len(hashes), -1)
+
+    @classmethod
+    def unstack(cls, stacked):
+        hashes = []
+        for row in stacked:
+            i = cls()
+            i._hash = row.tobytes()
+            hashes.append(i)
+        return hashes
+
+    @staticmethod
+    def differing_bits(stacked_a, stacked_b):
+        """Count differing bits between all pairs from two stacks."""
+        xor = stacked_a[:, None, :] ^ stacked_b[None, :, :]
+        return _popcount(xor).sum(axis=-1)
+
+    @classmethod
+    def distances(cls, stacked_a, stacked_b):
+        bits = stacked_a.shape[1] * 8
+        return cls.differing_bits(stacked_a, stacked_b) / bits
+
+    @classmethod
+    def close_pairs(cls, stacked, threshold):
+        bits = stacked.shape[1] * 8
+        max_bits = math.floor(threshold * bits)
+        for i, j, differing in _hamming_pairs(cls, stacked, max_bits):
+            yield i, j, differing / bits
+
     def __str__(self):
         return binascii.hexlify(self._hash).upper().decode()
 
@@ -116,6 +339,8 @@ class RadialImageHash(ImageHash):
 
     """Radial variance image hash algorithm"""
 
+    __slots__ = ()
+
     def __init__(self, *args):
         self._hash = b''
         ImageHash.__init__(self, *args)
@@ -136,14 +361,59 @@ class RadialImageHash(ImageHash):
     def distance(self, other: 'RadialImageHash'):
         return 1.0 - phash.crosscorr(self._hash, other._hash)
 
+    @classmethod
+    def stack(cls, hashes):
+        data = np.frombuffer(b''.join(h._hash for h in hashes), dtype=np.uint8)
+        return data.reshape(len(hashes), -1)
+
+    @classmethod
+    def unstack(cls, stacked):
+        hashes = []
+        for row in stacked:
+            i = cls()
+            i._hash = row.tobytes()
+            hashes.append(i)
+        return hashes
+
     def __str__(self):
         return binascii.hexlify(self._hash).upper().decode()
 
 
-def compute_hash(imagehash_class, filepath):
-    """Helper function which handles errors and prints result."""
+def _hamming_pairs(hash_class, stacked, max_bits):
+    """Find pairs of stacked hashes which differ in at most `max_bits` bits.
+
+    Implements :meth:`ImageHash.close_pairs` for Hamming distance.
+    The threshold is applied to integer bit counts, the caller converts
+    them to distances only for the matches. The bit counts are computed
+    in tiles of rows, so the intermediate arrays fit in
+    :attr:`ImageHash.batch_bytes`. Only the upper triangle is computed:
+    each tile is compared with columns from its first row on.
+
+    Returns:
+        Generator of tuples (i, j, bits), sorted by i, then j.
+
+    """
+    if max_bits < 0:
+        return
+    tile = max(1, hash_class.batch_bytes // stacked.nbytes)
+    for start in range(0, len(stacked), tile):
+        bits = hash_class.differing_bits(stacked[start:start + tile],
+                                         stacked[start:])
+        # Each pair once, no self-comparison
+        i, j = np.nonzero(np.triu(bits <= max_bits, k=1))
+        yield from zip((i + start).tolist(), (j + start).tolist(),
+                       bits[i, j].tolist())
+
+
+def compute_hash(algorithm, filepath):
+    """Helper function which handles errors and prints result.
+
+    Takes name of the algorithm instead of the class, so it can be
+    cheaply sent to worker process.
+
+    """
     try:
-        imghash = imagehash_class(filepath)
+        imghash = ImageHash.get_subclass(algorithm)(filepath)
     except IOError:
         return None
     print(imghash, filepath)
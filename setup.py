@@ -14,5 +14,5 @@ setup(
     ext_modules=cythonize('pyx/phash.pyx'),
     packages=['dedupimages'],
     scripts=['dedup-images.py'],
-    requires=['Cython']
+    requires=['Cython', 'numpy']
 )